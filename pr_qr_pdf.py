@@ -1,10 +1,16 @@
+import os
 import sys
-import re
 from pathlib import Path
 import segno
-from cairosvg import svg2png
-from PIL import Image
+import cairocffi
+from cairosvg.parser import Tree
+from cairosvg.surface import PDFSurface, PNGSurface
+from PIL import Image, ImageDraw, ImageFont, ImageOps
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import groupby, islice
 
 SVG_DIR = Path("qr_svgs")
 PNG_DIR = Path("qr_pngs")
@@ -13,74 +19,213 @@ SIZE_W, SIZE_H, QR_SIZE = 400, 600, 300
 DPI = 300
 A4_WIDTH_PX = int(210 / 25.4 * DPI)
 A4_HEIGHT_PX = int(297 / 25.4 * DPI)
+A4_WIDTH_PT = 210 / 25.4 * 72
+A4_HEIGHT_PT = 297 / 25.4 * 72
+QR_BORDER = 4
+PNG_COMPRESS_LEVEL = 1
 COLS, ROWS = 5, 5
 IMAGES_PER_PAGE = COLS * ROWS
 
-def generate_qr_svg(code: str, size_w=SIZE_W, size_h=SIZE_H, qr_size=QR_SIZE):
+LABEL_FONTS = ("Helvetica.ttf", "Arial.ttf", "DejaVuSans.ttf")
+MODULE_LEVELS = bytes([255, 0]) + bytes(254)
+
+def layout(size_w=SIZE_W, size_h=SIZE_H, qr_size=QR_SIZE):
     y_offset = 100
     qr_x = (size_w - qr_size) // 2
     qr_y = (size_h - qr_size) // 2 + y_offset
     label_font_size = int(size_w * 0.10)
     label_y = qr_y + qr_size
-    qr = segno.make(code, error='m', micro=False)
-    scale = qr_size / qr.symbol_size(1)[0]
-    qr_svg = qr.svg_inline(scale=scale, omitsize=True, dark='black', light='white')
-    if qr_svg.startswith('<?xml'):
-        qr_svg = qr_svg.split('?>', 1)[1]
-    inner = re.sub(r'^.*?<svg[^>]*>', '', qr_svg, flags=re.DOTALL)
-    inner = re.sub(r'</svg>\s*$', '', inner, flags=re.DOTALL)
+    return qr_x, qr_y, label_font_size, label_y
+
+def svg_frame(size_w=SIZE_W, size_h=SIZE_H):
     return f'''<?xml version="1.0" encoding="utf-8"?>
 <svg xmlns="http://www.w3.org/2000/svg" width="{size_w}" height="{size_h}" viewBox="0 0 {size_w} {size_h}">
     <rect width="100%" height="100%" fill="white"/>
     <rect x="1" y="1" width="{size_w-2}" height="{size_h-2}" fill="none" stroke="black" stroke-width="2"/>
     <circle cx="{size_w*0.5}" cy="{size_h*0.1}" r="{size_w*0.05}" fill="none" stroke="black" stroke-width="2"/>
-    <g transform="translate({qr_x},{qr_y})">{inner.strip()}</g>
-    <text x="{size_w//2}" y="{label_y}" font-size="{label_font_size}" font-family="Helvetica, Arial, sans-serif" text-anchor="middle" fill="black">{code}</text>
+'''
+
+@lru_cache(maxsize=None)
+def qr_version():
+    return segno.make("P0000", error='m', micro=False).version
+
+@lru_cache(maxsize=None)
+def svg_template(size_w=SIZE_W, size_h=SIZE_H, qr_size=QR_SIZE):
+    qr_x, qr_y, label_font_size, label_y = layout(size_w, size_h, qr_size)
+    prefix = svg_frame(size_w, size_h) + f'''    <g transform="translate({qr_x},{qr_y})">'''
+    mid = f'''</g>
+    <text x="{size_w//2}" y="{label_y}" font-size="{label_font_size}" font-family="Helvetica, Arial, sans-serif" text-anchor="middle" fill="black">'''
+    suffix = '''</text>
 </svg>'''
+    return prefix, mid, suffix
+
+def qr_path(matrix, border=QR_BORDER):
+    d = []
+    for y, row in enumerate(matrix, border):
+        x = border
+        for dark, run in groupby(row):
+            n = len(tuple(run))
+            if dark:
+                d.append(f"M{x} {y}h{n}v1h-{n}z")
+            x += n
+    return ''.join(d)
+
+@lru_cache(maxsize=1)
+def encode(code):
+    return segno.make(code, error='m', version=qr_version(), mode='alphanumeric', micro=False)
+
+def qr_svg(code: str, qr_size=QR_SIZE):
+    qr = encode(code)
+    n = len(qr.matrix) + 2 * QR_BORDER
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{qr_size}" height="{qr_size}" viewBox="0 0 {n} {n}">'
+            f'<rect width="{n}" height="{n}" fill="white"/><path d="{qr_path(qr.matrix)}" fill="black"/></svg>')
+
+def generate_qr_svg(code: str, size_w=SIZE_W, size_h=SIZE_H, qr_size=QR_SIZE):
+    prefix, mid, suffix = svg_template(size_w, size_h, qr_size)
+    return ''.join([prefix, qr_svg(code, qr_size), mid, code, suffix])
+
+def worker_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
 def code_generator(start, end):
     for i in range(start, end + 1):
         yield f"P{i:04d}"
 
+def rasterize(svg_bytes, width=SIZE_W, height=SIZE_H):
+    surface = PNGSurface(Tree(bytestring=svg_bytes), None, 96, output_width=width, output_height=height)
+    image = surface.cairo
+    image.flush()
+    img = Image.frombuffer('RGBA', (surface.width, surface.height), image.get_data(), 'raw', 'BGRA', image.get_stride(), 1).convert('L')
+    surface.finish()
+    return img
+
+@lru_cache(maxsize=None)
+def frame_image(size_w=SIZE_W, size_h=SIZE_H):
+    return rasterize((svg_frame(size_w, size_h) + '</svg>').encode('utf-8'), size_w, size_h)
+
+@lru_cache(maxsize=None)
+def label_font(size):
+    for name in LABEL_FONTS:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    return ImageFont.load_default(size)
+
+class TilePDFSurface(PDFSurface):
+    def __init__(self, tree, output, dpi, offset=(0, 0), **kwargs):
+        self.offset = offset
+        super().__init__(tree, output, dpi, **kwargs)
+
+    def _create_surface(self, width, height):
+        return self.output, width, height
+
+    def set_context_size(self, width, height, viewbox, tree):
+        # also called for the nested QR <svg>; only the root gets the slot offset
+        if tree.parent is None:
+            self.context.translate(*self.offset)
+        super().set_context_size(width, height, viewbox, tree)
+
+@lru_cache(maxsize=None)
+def glyph(ch, size):
+    font = label_font(size)
+    left, top, right, bottom = font.getbbox(ch, anchor='ls')
+    mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), ch, font=font, fill=255, anchor='ls')
+    return mask, left, top, font.getlength(ch)
+
+def draw_label(img, text, x, y, size):
+    glyphs = [glyph(ch, size) for ch in text]
+    pen = x - sum(g[3] for g in glyphs) / 2
+    for mask, left, top, advance in glyphs:
+        img.paste(0, (round(pen + left), y + top), mask)
+        pen += advance
+
+def qr_image(code, qr_size=QR_SIZE):
+    qr = encode(code)
+    n = len(qr.matrix)
+    img = Image.frombytes('L', (n, n), b''.join(qr.matrix).translate(MODULE_LEVELS))
+    img = ImageOps.expand(img, border=QR_BORDER, fill=255)
+    return img.resize((qr_size, qr_size), Image.Resampling.NEAREST)
+
+def render_png(code):
+    qr_x, qr_y, label_font_size, label_y = layout()
+    img = frame_image().copy()
+    img.paste(qr_image(code), (qr_x, qr_y))
+    draw_label(img, code, SIZE_W // 2, label_y, label_font_size)
+    return img
+
+def render_one(code, write_svg=False, write_png=False):
+    svg = generate_qr_svg(code)
+    if write_svg:
+        (SVG_DIR / f"{code}.svg").write_bytes(svg.encode('utf-8'))
+    if write_png:
+        render_png(code).save(PNG_DIR / f"{code}.png", compress_level=PNG_COMPRESS_LEVEL)
+    return svg
+
+def render_batch(codes, write_svg=False, write_png=False):
+    return [render_one(code, write_svg, write_png) for code in codes]
+
+def render_stream(ex, codes, chunksize, window, **kwargs):
+    batches = iter(lambda: list(islice(codes, chunksize)), [])
+    pending = deque(ex.submit(render_batch, batch, **kwargs) for batch in islice(batches, window))
+    while pending:
+        yield from pending.popleft().result()
+        for batch in islice(batches, 1):
+            pending.append(ex.submit(render_batch, batch, **kwargs))
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("start", nargs="?", type=int, default=301)
     parser.add_argument("end", nargs="?", type=int, default=500)
+    parser.add_argument("--svg", action="store_true", help=f"also write each code as an SVG to {SVG_DIR}/")
+    parser.add_argument("--png", action="store_true", help=f"also write each code as a PNG to {PNG_DIR}/")
     args = parser.parse_args()
 
-    SVG_DIR.mkdir(exist_ok=True)
-    PNG_DIR.mkdir(exist_ok=True)
-
-    png_paths = []
-    for code in code_generator(args.start, args.end):
-        svg_path = SVG_DIR / f"{code}.svg"
-        png_path = PNG_DIR / f"{code}.png"
-        svg_data = generate_qr_svg(code)
-        svg_path.write_text(svg_data, encoding='utf-8')
-        svg2png(bytestring=svg_data.encode('utf-8'), write_to=str(png_path), output_width=SIZE_W, output_height=SIZE_H)
-        png_paths.append(png_path)
-
-    images = []
-    for p in png_paths:
-        with Image.open(p) as img:
-            images.append(img.convert('RGB'))
-
-    if images:
-        h_space = (A4_WIDTH_PX - (COLS * SIZE_W)) // (COLS + 1)
-        v_space = (A4_HEIGHT_PX - (ROWS * SIZE_H)) // (ROWS + 1)
-        pages = []
-        for i in range(0, len(images), IMAGES_PER_PAGE):
-            page = Image.new('RGB', (A4_WIDTH_PX, A4_HEIGHT_PX), 'white')
-            for j, img in enumerate(images[i:i+IMAGES_PER_PAGE]):
-                row, col = divmod(j, COLS)
-                x = h_space + col * (SIZE_W + h_space)
-                y = v_space + row * (SIZE_H + v_space)
-                page.paste(img, (x, y))
-            pages.append(page)
-        pages[0].save(PDF_FILE, save_all=True, append_images=pages[1:], resolution=DPI)
-        print(f"✅ Created {PDF_FILE} with {len(pages)} page(s), {len(images)} QR codes.")
+    if args.svg:
+        SVG_DIR.mkdir(exist_ok=True)
+    if args.png:
+        PNG_DIR.mkdir(exist_ok=True)
+
+    h_space = (A4_WIDTH_PX - (COLS * SIZE_W)) // (COLS + 1)
+    v_space = (A4_HEIGHT_PX - (ROWS * SIZE_H)) // (ROWS + 1)
+    xs = [h_space + col * (SIZE_W + h_space) for col in range(COLS)]
+    ys = [v_space + row * (SIZE_H + v_space) for row in range(ROWS)]
+    slots = [(x, y) for y in ys for x in xs]
+
+    pdf = None
+    pages = codes = 0
+    workers = worker_count()
+    chunksize = max(1, min(IMAGES_PER_PAGE, (args.end - args.start + 1) // (8 * workers)))
+    # write to .part and rename when done so a failed run leaves no truncated PDF
+    part_file = PDF_FILE + ".part"
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            svgs = render_stream(ex, code_generator(args.start, args.end), chunksize, 2 * workers,
+                                 write_svg=args.svg, write_png=args.png)
+            while page := list(islice(svgs, IMAGES_PER_PAGE)):
+                if pdf is None:
+                    pdf = cairocffi.PDFSurface(part_file, A4_WIDTH_PT, A4_HEIGHT_PT)
+                for slot, svg in zip(slots, page):
+                    TilePDFSurface(Tree(bytestring=svg.encode('utf-8')), pdf, DPI, offset=slot)
+                pdf.show_page()
+                pages += 1
+                codes += len(page)
+        if pdf is not None:
+            pdf.finish()
+            os.replace(part_file, PDF_FILE)
+    except BaseException:
+        if pdf is not None:
+            pdf.finish()
+            os.remove(part_file)
+        raise
+
+    if pdf is not None:
+        print(f"✅ Created {PDF_FILE} with {pages} page(s), {codes} QR codes.")
     else:
-        print("No PNGs generated!")
+        print("No QR codes generated!")
 
 if __name__ == "__main__":
     main()